@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 from __future__ import annotations
 
-import os, sys, json, re, logging, unicodedata
+import os, sys, json, re, logging, unicodedata, threading, functools, time
 from pathlib import Path
+from urllib.parse import urlencode
 from typing import Optional, Tuple, Dict, List
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from itertools import groupby, islice
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from telegram import Update
 from telegram.ext import Updater, MessageHandler, CommandHandler, Filters, CallbackContext
 from telegram.error import Conflict as TgConflict
@@ -17,6 +22,9 @@ BITRIX_WEBHOOK_BASE = os.getenv("BITRIX_WEBHOOK_BASE", "").strip()     # нап
 BITRIX_CONTACT_URL = os.getenv("BITRIX_CONTACT_URL", "").strip()      # можно задать полную ссылку crm.contact.list.json
 DRIVE_ROOT_FOLDER_ID = os.getenv("DRIVE_ROOT_FOLDER_ID", "").strip()
 GOOGLE_SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_SERVICE_ACCOUNT_FILE", "/etc/secrets/main_acc.json").strip()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")    # публичный https-адрес сервиса; пусто — long polling
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
 
 # ========= Остальное — фиксируем в коде =========
 CATEGORY_ID = 1
@@ -49,19 +57,53 @@ def _assert_required_env():
     if missing:
         raise RuntimeError("Не заданы переменные окружения: " + ", ".join(missing))
 
+# ========= Регулярки (компилируем один раз) =========
+_RE_SPACES = re.compile(r"\s+")
+_RE_PUNCT = re.compile(r"[,\.;]+")
+_RE_WORD = re.compile(r"[^\s\-']+")
+_RE_DIGITS9_12 = re.compile(r"\d{9,12}")
+_RE_TITLE_SPLIT = re.compile(r"^(.*?),(.*)$")
+_RE_STAGE_CAT = re.compile(r"^C(\d+):")
+_RE_B24_BASE = re.compile(r"^(https://[^/]+/rest/\d+/[^/]+/)")
+_RE_B24_DOMAIN = re.compile(r"^(https://[^/]+)/")
+
 # ========= HTTP с таймаутами =========
+# Одна сессия на процесс: keep-alive и переиспользование TLS-соединений к Bitrix
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504]),
+))
+
 def http_get(url: str, **kwargs):
     kwargs.setdefault("timeout", 30)
-    return requests.get(url, **kwargs)
+    return _SESSION.get(url, **kwargs)
 
 def http_post(url: str, **kwargs):
     kwargs.setdefault("timeout", 30)
-    return requests.post(url, **kwargs)
+    return _SESSION.post(url, **kwargs)
 
 # ========= Drive / креды =========
 SA_EMAIL: Optional[str] = None
+_DRIVE = None
+_DRIVE_LOCK = threading.Lock()
 
 def build_drive():
+    """
+    Клиент Drive создаётся один раз на процесс, дальше переиспользуется
+    (Credentials сами обновляют токен). Discovery-документ берётся из
+    установленного пакета (static_discovery), без сетевого запроса.
+    """
+    global _DRIVE
+    if _DRIVE is not None:
+        return _DRIVE
+    with _DRIVE_LOCK:
+        if _DRIVE is None:
+            _DRIVE = _build_drive_uncached()
+    return _DRIVE
+
+def _build_drive_uncached():
     """
     Берём ключ сервис-аккаунта из файла:
     1) GOOGLE_SERVICE_ACCOUNT_FILE (ENV), иначе
@@ -77,7 +119,7 @@ def build_drive():
             creds = Credentials.from_service_account_file(creds_path, scopes=DRIVE_SCOPES)
             SA_EMAIL = getattr(creds, "service_account_email", None)
             log.info("[drive] using SA %s (file=%s)", SA_EMAIL, creds_path)
-            return build("drive", "v3", credentials=creds, cache_discovery=False)
+            return build("drive", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
         except Exception as e:
             raise RuntimeError(f"Не удалось прочитать ключ из {creds_path}: {e}")
 
@@ -89,7 +131,7 @@ def build_drive():
             creds = Credentials.from_service_account_file(str(candidate), scopes=DRIVE_SCOPES)
             SA_EMAIL = getattr(creds, "service_account_email", None)
             log.info("[drive] using SA %s (file=%s)", SA_EMAIL, candidate)
-            return build("drive", "v3", credentials=creds, cache_discovery=False)
+            return build("drive", "v3", credentials=creds, cache_discovery=False, static_discovery=True)
         except Exception as e:
             raise RuntimeError(f"Не удалось прочитать ключ из {candidate}: {e}")
 
@@ -110,8 +152,11 @@ def parse_http_error(he: HttpError) -> Tuple[int, str]:
         pass
     return int(code), msg
 
-def drive_search(drive, q, page_size=100, page_token=None,
-                 fields="files(id,name,mimeType,webViewLink,webContentLink,parents),nextPageToken"):
+# Запрашиваем у Drive только те поля, которые реально читаем
+_FILES_ID_NAME = "files(id,name),nextPageToken"
+_FILES_ID_NAME_MIME = "files(id,name,mimeType),nextPageToken"
+
+def drive_search(drive, q, fields: str, page_size=100, page_token=None):
     resp = drive.files().list(
         q=q,
         corpora="allDrives",
@@ -136,7 +181,7 @@ def list_child_folders(drive, parent_id, page_size=200):
     q = (f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false")
     items, token = [], None
     while True:
-        files, token = drive_search(drive, q, page_size=page_size, page_token=token, fields="files(id,name),nextPageToken")
+        files, token = drive_search(drive, q, page_size=page_size, page_token=token, fields=_FILES_ID_NAME)
         items.extend(files)
         if not token:
             break
@@ -145,11 +190,11 @@ def list_child_folders(drive, parent_id, page_size=200):
 def find_plan_file(drive, folder_id):
     target_exact = "Б. План Вашого звільнення.docx"
     q1 = f"'{folder_id}' in parents and name = '{target_exact}' and trashed=false and mimeType != 'application/vnd.google-apps.folder'"
-    res, _ = drive_search(drive, q1, page_size=5, fields="files(id,name,mimeType),nextPageToken")
+    res, _ = drive_search(drive, q1, page_size=5, fields=_FILES_ID_NAME)
     if res:
         return res[0]
     q2 = f"'{folder_id}' in parents and name contains 'План Вашого звільнення' and trashed=false and mimeType != 'application/vnd.google-apps.folder'"
-    res, _ = drive_search(drive, q2, page_size=20, fields="files(id,name,mimeType),nextPageToken")
+    res, _ = drive_search(drive, q2, page_size=20, fields=_FILES_ID_NAME_MIME)
     if res:
         pref = {
             "application/vnd.openxmlformats-officedocument.wordprocessingml.document": 3,
@@ -161,35 +206,27 @@ def find_plan_file(drive, folder_id):
 
 # ======== Нормализация ФИО/телефона ========
 APOSTROPHES = ["’", "`", "ʼ", "ʹ", "′", "＇", "ꞌ"]
+_APOS_TABLE = str.maketrans({a: "'" for a in APOSTROPHES})
+_NBSP_TABLE = str.maketrans({"\u00A0": " "})
 
 def _unify_apostrophes(s: str) -> str:
-    if not s: return ""
-    for a in APOSTROPHES: s = s.replace(a, "'")
-    return s
+    return s.translate(_APOS_TABLE) if s else ""
 
 def normalize_spaces(s: str) -> str:
     s = unicodedata.normalize("NFKC", s or "")
-    s = s.replace("\u00A0", " ")
-    return re.sub(r"\s+", " ", s).strip()
-
-def _smart_title(token: str) -> str:
-    token = token.strip()
-    if not token: return ""
-    parts_by_dash = token.split("-")
-    titled_parts = []
-    for part in parts_by_dash:
-        sub = part.split("'")
-        sub = [(x[:1].upper() + x[1:].lower()) if x else x for x in sub]
-        titled_parts.append("'".join(sub))
-    return "-".join(titled_parts)
+    s = s.translate(_NBSP_TABLE)
+    return _RE_SPACES.sub(" ", s).strip()
+
+def _title_word(m: re.Match) -> str:
+    w = m.group(0)
+    return w[:1].upper() + w[1:].lower()
 
 def normalize_fio_string(raw: str) -> str:
     s = normalize_spaces(_unify_apostrophes(raw or ""))
-    s = re.sub(r"[,\.;]+", " ", s)
+    s = _RE_PUNCT.sub(" ", s)
     s = normalize_spaces(s)
-    tokens = [t for t in s.split(" ") if t]
-    tokens = [_smart_title(t) for t in tokens]
-    return " ".join(tokens)
+    # регистр правим в частях между пробелами, дефисами и апострофами
+    return _RE_WORD.sub(_title_word, s)
 
 def build_fio_from_contact(contact: dict) -> str:
     last = normalize_fio_string(contact.get("LAST_NAME") or "")
@@ -198,8 +235,12 @@ def build_fio_from_contact(contact: dict) -> str:
     parts = [p for p in [last, first, middle] if p]
     return " ".join(parts).strip()
 
+def _digits_only(s: str) -> str:
+    # то же, что re.sub(r"\D", "", s), но без регулярки
+    return "".join(filter(str.isdecimal, s))
+
 def normalize_phone_e164_ua(phone: str) -> str:
-    digits = re.sub(r"\D", "", phone or "")
+    digits = _digits_only(phone or "")
     if not digits: return "+380"
     if digits.startswith("0"): digits = "380" + digits
     if digits.startswith("380"): body = digits[3:]
@@ -212,76 +253,88 @@ def build_folder_title(fio: str, phone_e164: str) -> str:
 
 def normalize_folder_title_for_compare(title: str) -> str:
     title = normalize_spaces(_unify_apostrophes(title or ""))
-    m = re.match(r"^(.*?),(.*)$", title)
+    m = _RE_TITLE_SPLIT.match(title)
     if not m:
         return normalize_fio_string(title)
     left, right = m.group(1).strip(), m.group(2).strip()
     left = normalize_fio_string(left)
-    digits = re.sub(r"\D", "", right)
+    digits = _digits_only(right)
     phone = normalize_phone_e164_ua(digits) if digits else normalize_phone_e164_ua(right)
     return f"{left}, {phone}"
 
-# ======== Поиск папки (exact -> fuzzy -> по телефону) ========
-def _extract_e164_from_title(title: str) -> Optional[str]:
-    digits = re.sub(r"\D", "", title or "")
+# ======== Поиск папки (exact -> по телефону -> fuzzy) ========
+def _extract_e164_from_title(title: str, last9: Optional[str] = None) -> Optional[str]:
+    digits = _digits_only(title or "")
     if len(digits) < 9:
         return None
-    m = re.findall(r"\d{9,12}", digits)
+    if last9 and last9 not in digits:
+        return None  # заведомо другой номер — дальше не разбираем
+    m = _RE_DIGITS9_12.findall(digits)
     if not m:
         return None
     return normalize_phone_e164_ua(m[-1])
 
+def _escape_drive_literal(s: str) -> str:
+    # Drive q: строковые литералы в одинарных кавычках (апостроф в ФИО ломал запрос)
+    return s.replace("\\", "\\\\").replace("'", "\\'")
+
 def find_folder_by_exact_name_under(drive, parent_id: str, exact_name: str) -> Optional[dict]:
-    q = (f"'{parent_id}' in parents and name = '{exact_name}' "
+    q = (f"'{parent_id}' in parents and name = '{_escape_drive_literal(exact_name)}' "
          f"and mimeType='application/vnd.google-apps.folder' and trashed=false")
-    res, _ = drive_search(drive, q, page_size=1, fields="files(id,name),nextPageToken")
+    res, _ = drive_search(drive, q, page_size=1, fields=_FILES_ID_NAME)
     return res[0] if res else None
 
 def find_folder_by_fuzzy(drive, parent_id: str, fio_norm: str, phone_last9: str) -> Optional[dict]:
     q = (f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' "
-         f"and name contains '{fio_norm.split(',')[0]}' and trashed=false")
+         f"and name contains '{_escape_drive_literal(fio_norm.split(',')[0])}' and trashed=false")
     items, token = [], None
     while True:
-        batch, token = drive_search(drive, q, page_size=100, page_token=token, fields="files(id,name),nextPageToken")
+        batch, token = drive_search(drive, q, page_size=100, page_token=token, fields=_FILES_ID_NAME)
         items.extend(batch)
         if not token:
             break
     if phone_last9:
-        items = [f for f in items if phone_last9 in re.sub(r"\D", "", f["name"])]
+        items = [f for f in items if phone_last9 in _digits_only(f["name"])]
     if items:
         items.sort(key=lambda f: len(f["name"]), reverse=True)
         return items[0]
     return None
 
-def find_folder_by_phone(drive, parent_id: str, phone_e164: str, expected_fio: Optional[str] = None) -> Optional[dict]:
-    e164 = normalize_phone_e164_ua(phone_e164)
-    digits = re.sub(r"\D", "", e164)          # 380XXXXXXXXX
-    last9  = digits[-9:]
-    op2, mid3, last4 = last9[:2], last9[2:5], last9[5:9]
-    patterns = [
-        f"{op2} {mid3} {last4}",
-        f"{mid3} {last4}",
-        last4,
-        last9,
-        ("+380 " + op2 + " " + mid3 + " " + last4),
-        ("+380" + op2 + mid3 + last4),
-    ]
-    conds = " or ".join([f"name contains '{p}'" for p in patterns if "'" not in p])
+def _folders_matching_phone(drive, parent_id: str, name_cond: str, e164: str, last9: str) -> List[dict]:
     q = (f"'{parent_id}' in parents and mimeType='application/vnd.google-apps.folder' "
-         f"and trashed=false and ({conds})")
+         f"and trashed=false and ({name_cond})")
     seen: Dict[str, dict] = {}
-    items, token = [], None
+    token = None
     while True:
-        batch, token = drive_search(drive, q, page_size=100, page_token=token, fields="files(id,name),nextPageToken")
+        batch, token = drive_search(drive, q, page_size=100, page_token=token, fields=_FILES_ID_NAME)
         for f in batch:
             seen.setdefault(f["id"], f)
         if not token:
             break
     matched = []
     for f in seen.values():
-        cand = _extract_e164_from_title(f["name"])
-        if cand and normalize_phone_e164_ua(cand) == e164:
+        if _extract_e164_from_title(f["name"], last9) == e164:
             matched.append(f)
+    return matched
+
+def find_folder_by_phone(drive, parent_id: str, phone_e164: str, last9: str,
+                         expected_fio: Optional[str] = None) -> Optional[dict]:
+    """phone_e164 — уже нормализованный +380XXXXXXXXX, last9 — его последние 9 цифр."""
+    # 1) основной случай: номер записан слитно. Drive ищет "contains" по началу
+    # слов, поэтому "+380XXXXXXXXX" (формат build_folder_title) нужен отдельным термом
+    compact = f"name contains '{last9}' or name contains '+380{last9}'"
+    matched = _folders_matching_phone(drive, parent_id, compact, phone_e164, last9)
+    if not matched:
+        # 2) старые названия с номером через пробелы — широкий OR-запрос
+        op2, mid3, last4 = last9[:2], last9[2:5], last9[5:9]
+        patterns = [
+            f"{op2} {mid3} {last4}",
+            f"{mid3} {last4}",
+            last4,
+            ("+380 " + op2 + " " + mid3 + " " + last4),
+        ]
+        conds = " or ".join([f"name contains '{p}'" for p in patterns])
+        matched = _folders_matching_phone(drive, parent_id, conds, phone_e164, last9)
     if not matched:
         return None
     if len(matched) == 1 or not expected_fio:
@@ -294,87 +347,132 @@ def find_folder_by_phone(drive, parent_id: str, phone_e164: str, expected_fio: O
     matched.sort(key=lambda x: (len(tokens(x["name"]) & exp), len(x["name"])), reverse=True)
     return matched[0]
 
-def find_client_folder_strict(drive, root_folder_id, expected_title: str, phone_e164: str):
+def find_client_folder_strict(drive, root_folder_id, expected_title: str, phone_e164: str, last9: str):
     # 1) exact
     exact = find_folder_by_exact_name_under(drive, root_folder_id, expected_title)
     if exact:
         return exact
-    # 2) fuzzy по ФИО + последние 9 цифр
+    # 2) по телефону — самый селективный и дешёвый признак
+    by_phone = find_folder_by_phone(drive, root_folder_id, phone_e164, last9, expected_fio=expected_title)
+    if by_phone:
+        return by_phone
+    # 3) fuzzy по ФИО + последние 9 цифр
     fio_only = normalize_folder_title_for_compare(expected_title)
-    last9 = re.sub(r"\D", "", phone_e164)[-9:]
-    fuzzy = find_folder_by_fuzzy(drive, root_folder_id, fio_only, last9)
-    if fuzzy:
-        return fuzzy
-    # 3) по телефону
-    return find_folder_by_phone(drive, root_folder_id, phone_e164, expected_fio=expected_title)
+    return find_folder_by_fuzzy(drive, root_folder_id, fio_only, last9)
 
 # ======== Bitrix ========
+# Оба зависят только от env — считаем один раз на процесс
+@functools.lru_cache(maxsize=1)
 def _b24_base() -> str:
     if BITRIX_WEBHOOK_BASE:
         return BITRIX_WEBHOOK_BASE.rstrip("/") + "/"
-    m = re.match(r"^(https://[^/]+/rest/\d+/[^/]+/)", BITRIX_CONTACT_URL)
+    m = _RE_B24_BASE.match(BITRIX_CONTACT_URL)
     if not m:
         raise RuntimeError("Не удалось определить базовый URL Bitrix")
     return m.group(1)
 
+@functools.lru_cache(maxsize=1)
 def _b24_domain() -> str:
     base = _b24_base()
-    m = re.match(r"^(https://[^/]+)/", base)
+    m = _RE_B24_DOMAIN.match(base)
     if not m:
         raise RuntimeError("Не удалось определить домен Bitrix")
     return m.group(1)
 
-def b24_post(method: str, payload: dict = None):
+def _b24_call(method: str, payload: dict = None) -> dict:
     url = f"{_b24_base()}{method}.json"
     r = http_post(url, json=payload or {})
     r.raise_for_status()
     data = r.json()
     if "error" in data:
         raise RuntimeError(f"B24 error {data.get('error')}: {data.get('error_description')}")
-    return data.get("result")
+    return data
+
+def b24_post(method: str, payload: dict = None):
+    return _b24_call(method, payload).get("result")
+
+_CONTACT_SELECT = ["ID","NAME","LAST_NAME","SECOND_NAME","PHONE"]
+_DEAL_SELECT = ["ID","TITLE","STAGE_ID","ASSIGNED_BY_ID","DATE_CREATE", CONSULTANT_FIELD, "CATEGORY_ID", "UF_CRM_62F6731E2FFAF"]
+
+def _pick_contact_by_phone(result: List[dict], norm: str) -> Optional[dict]:
+    if not result:
+        return None
+    want = _digits_only(norm)
+    for c in result:
+        for ph in c.get("PHONE", []):
+            if _digits_only(ph.get("VALUE", "")) == want:
+                return c
+    return None
 
 def find_contact_by_phone(phone: str):
     norm = normalize_phone_e164_ua(phone)
     if BITRIX_CONTACT_URL:
         r = http_get(
             BITRIX_CONTACT_URL,
-            params={"filter[PHONE]": norm, "select[]": ["ID","NAME","LAST_NAME","SECOND_NAME","PHONE"]},
+            params={"filter[PHONE]": norm, "select[]": _CONTACT_SELECT},
         )
     else:
         url = _b24_base() + "crm.contact.list.json"
-        r = http_get(url, params={"filter[PHONE]": norm, "select[]": ["ID","NAME","LAST_NAME","SECOND_NAME","PHONE"]})
+        r = http_get(url, params={"filter[PHONE]": norm, "select[]": _CONTACT_SELECT})
     r.raise_for_status()
     data = r.json()
-    result = data.get("result", [])
-    if not result:
-        return None
-    want = re.sub(r"\D", "", norm)
-    for c in result:
-        for ph in c.get("PHONE", []):
-            if re.sub(r"\D", "", ph.get("VALUE", "")) == want:
-                return c
+    return _pick_contact_by_phone(data.get("result", []), norm)
+
+def b24_batch(cmds: Dict[str, str], halt: int = 0) -> dict:
+    """Несколько методов за один HTTP-запрос: {ключ: "method?query"}."""
+    return b24_post("batch", {"halt": halt, "cmd": cmds}) or {}
+
+# Имена сотрудников почти не меняются — кешируем успешные ответы user.get
+_USER_NAME_CACHE: Dict[int, str] = {}
+
+def _user_display_name(users, user_id: int) -> Optional[str]:
+    if users and isinstance(users, list):
+        u = users[0]
+        parts = [u.get("NAME") or "", u.get("LAST_NAME") or "", u.get("SECOND_NAME") or ""]
+        name = " ".join([p for p in parts if p]).strip()
+        if name:
+            _USER_NAME_CACHE[user_id] = name
+        return name or f"ID {user_id}"
     return None
 
 def try_get_user_name(user_id: int) -> str:
+    cached = _USER_NAME_CACHE.get(user_id)
+    if cached is not None:
+        return cached
     try:
-        users = b24_post("user.get", {"ID": user_id})
-        if users and isinstance(users, list):
-            u = users[0]
-            parts = [u.get("NAME") or "", u.get("LAST_NAME") or "", u.get("SECOND_NAME") or ""]
-            name = " ".join([p for p in parts if p]).strip()
-            return name or f"ID {user_id}"
+        name = _user_display_name(b24_post("user.get", {"ID": user_id}), user_id)
+        if name:
+            return name
     except Exception:
         return f"ID {user_id} (немає прав)"
     return f"ID {user_id}"
 
+def get_user_names(user_ids: List[int]) -> Dict[int, str]:
+    """Имена для нескольких ID: всё, чего нет в кеше, — одним batch-запросом."""
+    out = {uid: _USER_NAME_CACHE[uid] for uid in user_ids if uid in _USER_NAME_CACHE}
+    missing = list(dict.fromkeys(uid for uid in user_ids if uid not in out))
+    if len(missing) == 1:
+        out[missing[0]] = try_get_user_name(missing[0])
+    elif missing:
+        try:
+            res = b24_batch({f"u{i}": f"user.get?ID={uid}" for i, uid in enumerate(missing)})
+            results = res.get("result") or {}
+        except Exception:
+            results = None
+        for i, uid in enumerate(missing):
+            if results is None or f"u{i}" not in results:
+                out[uid] = f"ID {uid} (немає прав)"
+            else:
+                out[uid] = _user_display_name(results[f"u{i}"], uid) or f"ID {uid}"
+    return out
+
 def resolve_consultant(value):
     if value is None or value == "":
         return "—"
     if isinstance(value, (list, tuple, set)):
-        names = []
-        for v in value:
-            s = str(v).strip()
-            names.append(try_get_user_name(int(s)) if s.isdigit() else s)
+        raw = [str(v).strip() for v in value]
+        names_by_id = get_user_names([int(s) for s in raw if s.isdigit()])
+        names = [names_by_id[int(s)] if s.isdigit() else s for s in raw]
         return ", ".join(names) if names else "—"
     s = str(value).strip()
     return try_get_user_name(int(s)) if s.isdigit() else s
@@ -382,30 +480,102 @@ def resolve_consultant(value):
 def get_last_deal_for_contact(contact_id: int, category_id: int):
     deals = b24_post("crm.deal.list", {
         "filter": {"CONTACT_ID": contact_id, "CATEGORY_ID": category_id},
-        "select": ["ID","TITLE","STAGE_ID","ASSIGNED_BY_ID","DATE_CREATE", CONSULTANT_FIELD, "CATEGORY_ID", "UF_CRM_62F6731E2FFAF"],
+        "select": _DEAL_SELECT,
         "order":  {"DATE_CREATE": "DESC"}
     })
     return deals[0] if deals else None
 
+# Стадии воронок меняются редко — кешируем на всё время жизни процесса
+_STAGE_MAP_CACHE: Dict[int, Dict[str, str]] = {}
+
 def get_stage_map_for_category(category_id: int):
+    m = _STAGE_MAP_CACHE.get(category_id)
+    if m is not None:
+        return m
     items = b24_post("crm.dealcategory.stage.list", {"id": category_id})
-    return {it["STATUS_ID"]: it["NAME"] for it in items}
+    m = {it["STATUS_ID"]: it["NAME"] for it in items}
+    _STAGE_MAP_CACHE[category_id] = m
+    return m
+
+def find_contact_and_last_deal(phone: str, category_id: int) -> Tuple[Optional[dict], Optional[dict]]:
+    """
+    Контакт по телефону + его последняя сделка одним batch-запросом.
+    Сделка и ответственный подтягиваются через $result[...] на стороне Bitrix,
+    заодно прогреваются кеши стадий и имён сотрудников.
+    """
+    if BITRIX_CONTACT_URL and not BITRIX_CONTACT_URL.startswith(_b24_base()):
+        # контакты ищем через отдельный вебхук — batch к нему не привязать
+        contact = find_contact_by_phone(phone)
+        if not contact:
+            return None, None
+        return contact, get_last_deal_for_contact(int(contact["ID"]), category_id)
+
+    norm = normalize_phone_e164_ua(phone)
+    deal_qs = urlencode({
+        "filter[CATEGORY_ID]": category_id,
+        "order[DATE_CREATE]": "DESC",
+        "select[]": _DEAL_SELECT,
+    }, doseq=True)
+    cmds = {
+        "contact": "crm.contact.list?" + urlencode({"filter[PHONE]": norm, "select[]": _CONTACT_SELECT}, doseq=True),
+        "deal": f"crm.deal.list?{deal_qs}&filter[CONTACT_ID]=$result[contact][0][ID]",
+        "user": "user.get?ID=$result[deal][0][ASSIGNED_BY_ID]",
+    }
+    if category_id not in _STAGE_MAP_CACHE:
+        cmds["stages"] = f"crm.dealcategory.stage.list?id={category_id}"
+
+    res = b24_batch(cmds)
+    results = res.get("result") or {}
+    errors = res.get("result_error") or {}
+    if "contact" in errors:
+        raise RuntimeError(f"B24 error (contact.list): {errors['contact']}")
+
+    if results.get("stages"):
+        _STAGE_MAP_CACHE[category_id] = {it["STATUS_ID"]: it["NAME"] for it in results["stages"]}
+
+    contacts = results.get("contact") or []
+    contact = _pick_contact_by_phone(contacts, norm)
+    if not contact:
+        return None, None
+    if contact is not contacts[0]:
+        # сервер связал сделку с первым контактом, а совпал другой — добираем отдельно
+        return contact, get_last_deal_for_contact(int(contact["ID"]), category_id)
+
+    if "deal" in errors:
+        # как и get_last_deal_for_contact: ошибка B24 — не то же самое, что "угоды нет"
+        raise RuntimeError(f"B24 error (deal.list): {errors['deal']}")
+    deals = results.get("deal") or []
+    deal = deals[0] if deals else None
+    if deal and results.get("user"):
+        _user_display_name(results["user"], int(deal.get("ASSIGNED_BY_ID") or 0))
+    return contact, deal
 
 # ======== История стадий / длительность ========
-_STAGE_MAP_CACHE: Dict[int, Dict[str, str]] = {}
 
 def _stage_name_by_sid(stage_id: str) -> str:
     if not stage_id:
         return "—"
-    m = re.match(r"^C(\d+):", stage_id)
+    m = _RE_STAGE_CAT.match(stage_id)
     if not m:
         return stage_id
-    cat = int(m.group(1))
-    if cat not in _STAGE_MAP_CACHE:
-        _STAGE_MAP_CACHE[cat] = get_stage_map_for_category(cat)
-    return _STAGE_MAP_CACHE[cat].get(stage_id, stage_id)
+    return get_stage_map_for_category(int(m.group(1))).get(stage_id, stage_id)
+
+_TZ_CACHE: Dict[str, timezone] = {"Z": timezone.utc}
 
 def _parse_iso(ts: str) -> datetime:
+    # Быстрый путь под формат Bitrix: 2024-01-15T12:34:56+03:00
+    if ts and len(ts) in (20, 25) and ts[4] == "-" and ts[10] == "T":
+        tzs = ts[19:]
+        tz = _TZ_CACHE.get(tzs)
+        if tz is None and len(tzs) == 6 and tzs[0] in "+-" and tzs[3] == ":":
+            off = timedelta(hours=int(tzs[1:3]), minutes=int(tzs[4:6]))
+            tz = _TZ_CACHE[tzs] = timezone(off if tzs[0] == "+" else -off)
+        if tz is not None:
+            try:
+                return datetime(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                                int(ts[11:13]), int(ts[14:16]), int(ts[17:19]), tzinfo=tz)
+            except ValueError:
+                pass
     ts = (ts or "").replace("Z", "+00:00")
     return datetime.fromisoformat(ts)
 
@@ -425,70 +595,46 @@ def get_deal_stage_history(deal_id: int, asc: bool = True, limit: int = 300) ->
         "entityTypeId": 2,
         "filter": {"OWNER_ID": int(deal_id)},
         "order": {"CREATED_TIME": "ASC" if asc else "DESC"},
-        "select": ["ID","OWNER_ID","STAGE_ID","CREATED_TIME","CATEGORY_ID"],
+        "select": ["STAGE_ID","CREATED_TIME"],
         "start": 0
     }
+    # Только первая страница (до 50 записей): вся история длинных сделок
+    # не влезает в одно сообщение Telegram (4096 символов)
     res = b24_post("crm.stagehistory.list", payload)
     items = res.get("items", res) if isinstance(res, dict) else (res or [])
-    items = items[:limit]
-    items.sort(key=lambda r: r.get("CREATED_TIME", ""))
-
-    out, prev_sid = [], None
-    for r in items:
-        sid = r.get("STAGE_ID")
-        if sid == prev_sid:
-            continue
-        out.append(r); prev_sid = sid
-    return out
+    # Порядок задаёт сервер (order.CREATED_TIME). Результат всегда от старых к
+    # новым: asc=False лишь выбирает последние записи вместо первых.
+    # Подряд идущие записи с одной и той же стадией схлопываем в первую
+    rows = list(islice(items, limit))
+    if not asc:
+        rows.reverse()
+    return [next(g) for _, g in groupby(rows, key=lambda r: r.get("STAGE_ID"))]
 
 def compute_stage_segments(rows: List[dict]) -> List[dict]:
-    segs = []
-    for i, r in enumerate(rows):
-        start = _parse_iso(r.get("CREATED_TIME"))
-        end = _parse_iso(rows[i + 1]["CREATED_TIME"]) if i + 1 < len(rows) else datetime.now(start.tzinfo or timezone.utc)
-        segs.append({
-            "stage_id": r.get("STAGE_ID"),
-            "start": start,
-            "end": end,
-            "duration": end - start,
-        })
-        # end defaults to "now" for the last segment
-    return segs
+    # каждый CREATED_TIME парсим один раз; конец сегмента = начало следующего,
+    # для последнего — "сейчас"
+    times = [_parse_iso(r.get("CREATED_TIME")) for r in rows]
+    ends = times[1:] + [datetime.now(timezone.utc)]
+    return [
+        {"stage_id": r.get("STAGE_ID"), "start": start, "end": end, "duration": end - start}
+        for r, start, end in zip(rows, times, ends)
+    ]
 
 # ======== /check ========
 CHECK_RX = re.compile(r"^\s*/?check\s+(.+)$", re.IGNORECASE)
 
-def handle_check(update: Update, ctx: CallbackContext, raw_phone: str):
-    phone = normalize_phone_e164_ua(raw_phone)
-    if len(re.sub(r"\D", "", phone)) < 12:
-        update.message.reply_text("Будь ласка, надішліть номер у форматі: /check +380XXXXXXXXX")
-        return
-
-    contact = find_contact_by_phone(phone)
-    if not contact:
-        update.message.reply_text("❌ Клієнта з таким номером у CRM не знайдено.")
-        return
-
-    client_fio = build_fio_from_contact(contact)
-    contact_id = int(contact["ID"])
-
-    deal = get_last_deal_for_contact(contact_id, CATEGORY_ID)
-    if not deal:
-        update.message.reply_text(f"ℹ️ У клієнта немає угоди у воронці №{CATEGORY_ID}.")
-        return
+# Независимые запросы к Bitrix/Drive внутри /check выполняем параллельно:
+# requests/httplib2 отпускают GIL на сокетах, так что потоков достаточно.
+_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="check")
+_FUTURE_TIMEOUT = 30  # общий бюджет на все параллельные запросы одного /check
+# Клиент Drive один на процесс и держит один httplib2.Http, который не
+# потокобезопасен: одновременно с ним работает только один поток
+_DRIVE_USE_LOCK = threading.Lock()
 
-    deal_id = int(deal["ID"])
-    stage_map = get_stage_map_for_category(CATEGORY_ID)
-    stage_name = stage_map.get(deal.get("STAGE_ID"), deal.get("STAGE_ID") or "—")
-    resp_id = int(deal.get("ASSIGNED_BY_ID") or 0)
-    resp_name = try_get_user_name(resp_id) if resp_id else "—"
+_DT_FMT = "%Y-%m-%d %H:%M"
+_HIST_HDR = "🧭 <b>Історія стадій:</b>\n"
 
-    consultant_raw = deal.get(CONSULTANT_FIELD)
-    consultant_name = resolve_consultant(consultant_raw)
-
-    deal_link = f"{_b24_domain()}/crm/deal/details/{deal_id}/"
-    
-    debt = deal.get("UF_CRM_62F6731E2FFAF") or "—"  # сумма из сделки
+def _lookup_home_address(contact_id: int) -> str:
     # ==== Прописка (ContactRequisiteHomeAddressText) ====
     address = "—"
     try:
@@ -515,51 +661,117 @@ def handle_check(update: Update, ctx: CallbackContext, raw_phone: str):
                 address = rows[0].get("ADDRESS_1") or rows[0].get("ADDRESS") or "—"
     except Exception as e:
         log.warning("home address fetch error: %s", e)
+    return address
 
+def _lookup_docs(client_fio: str, phone: str, last9: str) -> str:
     # ==== Google Drive ====
-    doc_line = "📎 <b>Документи:</b> —"
+    with _DRIVE_USE_LOCK:
+        return _lookup_docs_locked(client_fio, phone, last9)
+
+def _lookup_docs_locked(client_fio: str, phone: str, last9: str) -> str:
     try:
         drive = build_drive()
         expected_folder_title = build_folder_title(client_fio, phone)
 
-        folder = find_client_folder_strict(drive, DRIVE_ROOT_FOLDER_ID, expected_folder_title, phone)
+        folder = find_client_folder_strict(drive, DRIVE_ROOT_FOLDER_ID, expected_folder_title, phone, last9)
         if folder:
             plan = find_plan_file(drive, folder["id"])
             if plan:
                 view = get_view_link(drive, plan["id"])
-                doc_line = f'📎 <b>Документи:</b> <a href="{view}">Б. План Вашого звільнення</a>'
-            else:
-                doc_line = "📎 <b>Документи:</b> План не знайдено у папці клієнта"
-        else:
-            doc_line = "📎 <b>Документи:</b> Папку клієнта не знайдено"
+                return f'📎 <b>Документи:</b> <a href="{view}">Б. План Вашого звільнення</a>'
+            return "📎 <b>Документи:</b> План не знайдено у папці клієнта"
+        return "📎 <b>Документи:</b> Папку клієнта не знайдено"
     except HttpError as he:
         code, reason = parse_http_error(he)
-        doc_line = f"📎 <b>Документи:</b> Помилка доступу до Drive ({code} {reason})"
+        return f"📎 <b>Документи:</b> Помилка доступу до Drive ({code} {reason})"
     except Exception as e:
         log.exception("Drive error")
-        doc_line = f"📎 <b>Документи:</b> Помилка: {e}"
+        return f"📎 <b>Документи:</b> Помилка: {e}"
 
+def _lookup_stage_history(deal_id: int) -> List[dict]:
+    try:
+        return get_deal_stage_history(deal_id, asc=True)
+    except Exception as e:
+        log.warning("stage history error: %s", e)
+        return []
+
+def _format_stage_history(hist: List[dict]) -> Tuple[str, str]:
     # ==== История стадий / длительность текущей ====
+    # Вызывается после того, как карта стадий уже получена (и закеширована)
     stage_extra = ""
     history_block = ""
     try:
-        hist = get_deal_stage_history(deal_id, asc=True)
         if hist:
             segs = compute_stage_segments(hist)
             cur = segs[-1]
             cur_dur = _fmt_tdelta(cur["duration"])
             stage_extra = f" ({cur_dur})"
 
-            lines = []
-            for i, s in enumerate(segs):
-                start_s = s["start"].strftime('%Y-%m-%d %H:%M')
-                dur_s = _fmt_tdelta(s["duration"])
-                name = _stage_name_by_sid(s["stage_id"])
-                tail = " (поточна)" if i == len(segs) - 1 else f" (до {s['end'].strftime('%Y-%m-%d %H:%M')})"
-                lines.append(f"• {start_s} → {name} — {dur_s}{tail}")
-            history_block = "🧭 <b>Історія стадій:</b>\n" + "\n".join(lines)
+            # конец сегмента = начало следующего, так что каждую дату форматируем один раз
+            starts = [s["start"].strftime(_DT_FMT) for s in segs]
+            tails = [f" (до {st})" for st in starts[1:]] + [" (поточна)"]
+            history_block = _HIST_HDR + "\n".join(
+                f"• {start_s} → {_stage_name_by_sid(s['stage_id'])} — {_fmt_tdelta(s['duration'])}{tail}"
+                for s, start_s, tail in zip(segs, starts, tails)
+            )
     except Exception as e:
         log.warning("stage history error: %s", e)
+    return stage_extra, history_block
+
+def _result_or(fut, default, what: str, deadline: float):
+    # Медленный запрос не должен оставить пользователя без ответа
+    try:
+        return fut.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeoutError:
+        log.warning("%s lookup did not finish within %ss", what, _FUTURE_TIMEOUT)
+        return default
+
+def handle_check(update: Update, ctx: CallbackContext, raw_phone: str):
+    # Дешёвая локальная проверка до любого запроса в Bitrix: normalize_phone_e164_ua
+    # дополняет до +380 даже мусор, поэтому смотрим на цифры исходного ввода
+    raw_digits = _digits_only(raw_phone or "")
+    phone = normalize_phone_e164_ua(raw_phone)
+    phone_digits = _digits_only(phone)
+    if not (9 <= len(raw_digits) <= 12) or len(phone_digits) != 12:
+        update.message.reply_text("Будь ласка, надішліть номер у форматі: /check +380XXXXXXXXX")
+        return
+    last9 = phone_digits[-9:]  # считаем один раз и передаём в поиск по Drive
+
+    contact, deal = find_contact_and_last_deal(phone, CATEGORY_ID)
+    if not contact:
+        update.message.reply_text("❌ Клієнта з таким номером у CRM не знайдено.")
+        return
+
+    client_fio = build_fio_from_contact(contact)
+    contact_id = int(contact["ID"])
+
+    if not deal:
+        update.message.reply_text(f"ℹ️ У клієнта немає угоди у воронці №{CATEGORY_ID}.")
+        return
+
+    deal_id = int(deal["ID"])
+    resp_id = int(deal.get("ASSIGNED_BY_ID") or 0)
+    consultant_raw = deal.get(CONSULTANT_FIELD)
+
+    # Всё ниже зависит только от contact/deal — запускаем разом
+    fut_stages = _POOL.submit(get_stage_map_for_category, CATEGORY_ID)
+    fut_resp = _POOL.submit(try_get_user_name, resp_id) if resp_id else None
+    fut_cons = _POOL.submit(resolve_consultant, consultant_raw)
+    fut_addr = _POOL.submit(_lookup_home_address, contact_id)
+    fut_docs = _POOL.submit(_lookup_docs, client_fio, phone, last9)
+    fut_hist = _POOL.submit(_lookup_stage_history, deal_id)
+    deadline = time.monotonic() + _FUTURE_TIMEOUT
+
+    deal_link = f"{_b24_domain()}/crm/deal/details/{deal_id}/"
+    debt = deal.get("UF_CRM_62F6731E2FFAF") or "—"  # сумма из сделки
+
+    stage_map = _result_or(fut_stages, {}, "stage map", deadline)
+    stage_name = stage_map.get(deal.get("STAGE_ID"), deal.get("STAGE_ID") or "—")
+    resp_name = _result_or(fut_resp, "—", "responsible", deadline) if fut_resp else "—"
+    consultant_name = _result_or(fut_cons, "—", "consultant", deadline)
+    address = _result_or(fut_addr, "—", "home address", deadline)
+    doc_line = _result_or(fut_docs, "📎 <b>Документи:</b> —", "Drive", deadline)
+    stage_extra, history_block = _format_stage_history(_result_or(fut_hist, [], "stage history", deadline))
 
     text = (
         f"📄 <b>Клієнт:</b> {client_fio}\n"
@@ -592,6 +804,9 @@ def on_check_cmd(update: Update, ctx: CallbackContext):
     handle_check(update, ctx, raw)
 
 # ======== Запуск ========
+# Обрабатываем только обычные сообщения — остальные типы апдейтов Telegram не шлёт
+ALLOWED_UPDATES = ["message"]
+
 def main():
     _assert_required_env()
 
@@ -610,18 +825,32 @@ def main():
         request_kwargs={"read_timeout": 30, "connect_timeout": 10},
     )
 
-    # Чтобы не было 409 на Render, отключаем возможный вебхук:
+    dp = updater.dispatcher
+    dp.add_handler(CommandHandler("check", on_check_cmd, pass_args=True))
+    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, on_text))
+
+    if WEBHOOK_URL:
+        # Telegram сам присылает апдейты — без пустых getUpdates
+        updater.start_webhook(
+            listen=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+            drop_pending_updates=True,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+        log.info("[tg] webhook on %s:%s", WEBHOOK_HOST, WEBHOOK_PORT)
+        updater.idle()
+        return
+
+    # Fallback (локально): long polling. Чтобы не было 409, отключаем возможный вебхук:
     try:
         updater.bot.delete_webhook(drop_pending_updates=True)
     except Exception:
         pass
 
-    dp = updater.dispatcher
-    dp.add_handler(CommandHandler("check", on_check_cmd, pass_args=True))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, on_text))
-
     try:
-        updater.start_polling(timeout=30, drop_pending_updates=True)
+        updater.start_polling(timeout=30, drop_pending_updates=True, allowed_updates=ALLOWED_UPDATES)
         updater.idle()
     except TgConflict:
         log.error("Conflict 409: другой процесс уже выполняет getUpdates. Останови лишний инстанс.")